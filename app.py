@@ -1,32 +1,123 @@
 import streamlit as st
 import pandas as pd
+import pyarrow.parquet as pq
 import json
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 # Set page config
 st.set_page_config(page_title="Conversation Viewer", layout="wide")
 
 
-# Load preprocessed data
-@st.cache_data
-def load_data():
-    # Load the preprocessed DataFrame
-    df = pd.read_parquet("processed_data/conversations.parquet")
+PARQUET_PATH = "processed_data/conversations.parquet"
+RAW_PARQUET_PATH = "processed_data/raw_conversations.parquet"
+
+# Columns the UI actually reads; the heavy raw payloads live in their own file
+METADATA_COLUMNS = [
+    "conversation_id",
+    "assignment_id",
+    "assignment_name",
+    "assignment_type",
+    "assignment_subject",
+    "assignment_grade",
+    "has_concepts",
+    "concepts",
+    "student_id",
+    "student_name",
+    "teacher_id",
+    "teacher_name",
+    "student_reading",
+    "is_popular_assignment",
+]
+
+
+# Load preprocessed data. cache_resource stores the frame by reference:
+# it is immutable between preprocess runs, so there is no point paying
+# cache_data's hash/serialize cost on every access (callers must not mutate)
+@st.cache_resource
+def load_data(concept_choice=None):
+    # Load only the metadata columns (raw conversations are loaded lazily);
+    # memory-mapping lets the OS page in data on demand with zero-copy
+    # buffers, and a has_concepts filter lets Arrow skip whole row groups
+    filters = None
+    if concept_choice == "Teacher-selected questions":
+        filters = [("has_concepts", "=", True)]
+    elif concept_choice == "100% AI selected questions":
+        filters = [("has_concepts", "=", False)]
+    table = pq.read_table(
+        PARQUET_PATH, columns=METADATA_COLUMNS, filters=filters, memory_map=True
+    )
+    # Index by conversation_id so row lookups are O(1) instead of a mask scan
+    return table.to_pandas(self_destruct=True).set_index(
+        "conversation_id", drop=False
+    )
+
+
+# Open the raw payload parquet once and map conversation_id -> row group
+# (preprocess.py writes one row group per conversation)
+@st.cache_resource
+def raw_parquet_index():
+    parquet_file = pq.ParquetFile(RAW_PARQUET_PATH, memory_map=True)
+    ids = parquet_file.read(columns=["conversation_id"])["conversation_id"]
+    return parquet_file, {cid: i for i, cid in enumerate(ids.to_pylist())}
 
-    # Load the raw conversations
-    with open("processed_data/raw_conversations.json", "r") as f:
-        raw_conversations = json.load(f)
 
-    return df, raw_conversations
+# Lazily load a single raw conversation by reading only its row group
+# (by-reference cache; the display code only reads the payload)
+@st.cache_resource(max_entries=64)
+def load_conversation(conversation_id):
+    parquet_file, index = raw_parquet_index()
+    row_group = parquet_file.read_row_group(
+        index[conversation_id], columns=["raw"]
+    )
+    raw = row_group["raw"][0].as_py()
+    # Same preference order as preprocess.py's dump_payload
+    if msgpack is not None:
+        return msgpack.unpackb(raw, raw=False)
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+# Cache the filtered view and its lookup dict per filter choice so widget
+# interactions don't recompute them on every rerun (by reference, no hashing)
+@st.cache_resource
+def get_filtered(concept_choice: str):
+    # Normalize the unfiltered choice to None so it hits the same cache
+    # entry as the module-level load_data(None) call (Streamlit keys the
+    # cache on the arguments actually passed)
+    if concept_choice == "All conversations":
+        concept_choice = None
+    filtered_df = load_data(concept_choice)
+
+    # id -> assignment name; the selectbox format_func is called per option
+    # and a boolean-mask scan there would be O(N^2)
+    id_to_name = dict(
+        zip(
+            filtered_df["conversation_id"].tolist(),
+            filtered_df["assignment_name"].tolist(),
+        )
+    )
+    return filtered_df, id_to_name, len(filtered_df)
 
 
 # Check if preprocessed data exists
-if not Path("processed_data/conversations.parquet").exists():
+if not Path(PARQUET_PATH).exists() or not Path(RAW_PARQUET_PATH).exists():
     st.error("Preprocessed data not found. Please run preprocess.py first.")
     st.stop()
 
-# Load data
-df, raw_conversations = load_data()
+# Load data (pass None explicitly: load_data() and load_data(None) would be
+# two distinct cache entries, each holding a full copy of the frame)
+df = load_data(None)
 
 # Sidebar filters
 st.sidebar.title("Filters")
@@ -48,15 +139,11 @@ concept_options = [
 ]
 selected_concepts = st.sidebar.selectbox("Concept Filter", concept_options)
 
-# Apply filters
-filtered_df = df.copy()
-if selected_concepts == "Teacher-selected questions":
-    filtered_df = filtered_df[filtered_df["has_concepts"] == True]
-elif selected_concepts == "100% AI selected questions":
-    filtered_df = filtered_df[filtered_df["has_concepts"] == False]
+# Apply filters (cached per filter choice)
+filtered_df, id_to_name, filtered_count = get_filtered(selected_concepts)
 
-# Display conversation count
-st.sidebar.metric("Filtered Conversations", len(filtered_df))
+# Display conversation count (cached scalar, no re-traversal per rerun)
+st.sidebar.metric("Filtered Conversations", filtered_count)
 
 # Main content
 st.title("Conversation Viewer")
@@ -65,13 +152,13 @@ st.title("Conversation Viewer")
 selected_conversation = st.selectbox(
     "Select Conversation",
     filtered_df["conversation_id"].tolist(),
-    format_func=lambda x: f"Conversation {x} - {filtered_df[filtered_df['conversation_id'] == x]['assignment_name'].iloc[0]}",
+    format_func=lambda x: f"Conversation {x} - {id_to_name[x]}",
 )
 
 # Display conversation
 if selected_conversation:
-    conversation_data = raw_conversations[selected_conversation]
-    metadata = df[df["conversation_id"] == selected_conversation].iloc[0]
+    conversation_data = load_conversation(selected_conversation)
+    metadata = df.loc[selected_conversation]
 
     # Display student reading/essay if available in a dialog
     reading_type = (
@@ -95,48 +182,24 @@ if selected_conversation:
 
     st.divider()
 
-    # Display questions and responses
-    question_labels = [
-        "I1: Hook Question",
-        "BQ1: Recall Question",
-        "P1: Probing Question (Follow-up to BQ1)",
-        "BQ2: Analytical Question",
-        "P2: Probing Question (Follow-up to BQ2)",
-        "BQ3: Open-ended Question",
-    ]
-    question_descriptions = [
-        "Intrigues the student about the reading",
-        "Simple retrieve and recall question with a discrete answer",
-        "Follow-up probing question for Question 2",
-        "More challenging analytical question requiring synthesis",
-        "Probing question based on the student's response to Question 4",
-        "Abstract, open-ended question to stimulate creativity",
-    ]
-
     # Create tabs for Questions and Student Work/Reading
     tab1, tab2 = st.tabs(["Questions", f"{reading_type}"])
 
     with tab1:
-        for i, question in enumerate(conversation_data["questions"], 1):
-            with st.expander(f"{question_labels[i-1]}", expanded=False):
-                st.info(f"**Question Type:** {question_descriptions[i-1]}")
-                if (
-                    "conversation_flow" in conversation_data.get("assignment", {})
-                    and len(conversation_data["assignment"]["conversation_flow"])
-                    > i - 1
-                ):
-                    concept = conversation_data["assignment"]["conversation_flow"][
-                        i - 1
-                    ].get("concept")
-                    if concept:
-                        st.warning(
-                            "**Teacher asked AI to include this concept:** " + concept
-                        )
+        # Questions are flattened into render-ready dicts by preprocess.py
+        for question in conversation_data["questions_render"]:
+            with st.expander(question["label"], expanded=False):
+                st.info(f"**Question Type:** {question['description']}")
+                if question["concept"]:
+                    st.warning(
+                        "**Teacher asked AI to include this concept:** "
+                        + question["concept"]
+                    )
                 st.write("**Question:**")
                 st.write(question["question"])
                 st.write("**Student Response:**")
                 st.write(question["response"])
-                if "improved_response" in question and question["improved_response"]:
+                if question["improved_response"]:
                     st.write("**Improved Response (GPT-improved):**")
                     st.write(question["improved_response"])
 
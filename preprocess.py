@@ -1,14 +1,43 @@
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import json
 from pathlib import Path
 import random
 from collections import Counter
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def has_valid_concepts(conversation):
-    """Check if conversation has non-empty concepts."""
-    concepts = conversation.get("assignment", {}).get("concepts", [])
-    return bool(concepts) and all(concepts)  # Check if list exists and no empty strings
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+QUESTION_LABELS = [
+    "I1: Hook Question",
+    "BQ1: Recall Question",
+    "P1: Probing Question (Follow-up to BQ1)",
+    "BQ2: Analytical Question",
+    "P2: Probing Question (Follow-up to BQ2)",
+    "BQ3: Open-ended Question",
+]
+QUESTION_DESCRIPTIONS = [
+    "Intrigues the student about the reading",
+    "Simple retrieve and recall question with a discrete answer",
+    "Follow-up probing question for Question 2",
+    "More challenging analytical question requiring synthesis",
+    "Probing question based on the student's response to Question 4",
+    "Abstract, open-ended question to stimulate creativity",
+]
 
 
 def get_student_reading(conversation):
@@ -23,6 +52,100 @@ def get_student_reading(conversation):
     return conversation.get("student_work")
 
 
+def load_json_bytes(raw):
+    """Parse JSON bytes, preferring orjson (skips the text-mode decode pass)."""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def load_conversations():
+    """Load conversations.json fully, repairing trailing commas if needed."""
+    raw = Path("conversations.json").read_bytes()
+    try:
+        return load_json_bytes(raw)
+    except ValueError as e:
+        print(f"Error decoding JSON: {e}")
+        print("Attempting to fix the JSON file...")
+        # Remove any trailing commas in arrays or objects, reusing the bytes
+        # already in memory rather than re-reading the file
+        raw = raw.replace(b",]", b"]").replace(b",}", b"}")
+        # Attempt to load the fixed JSON
+        try:
+            return load_json_bytes(raw)
+        except ValueError as e:
+            print(f"Unable to fix JSON file. Error: {e}")
+            return None
+
+
+def build_questions_render(conversation):
+    """Flatten each question into a render-ready dict for the app's display loop."""
+    flow = conversation.get("assignment", {}).get("conversation_flow", [])
+    rendered = []
+    for i, question in enumerate(conversation.get("questions", [])):
+        rendered.append(
+            {
+                "label": (
+                    QUESTION_LABELS[i]
+                    if i < len(QUESTION_LABELS)
+                    else f"Question {i + 1}"
+                ),
+                "description": (
+                    QUESTION_DESCRIPTIONS[i] if i < len(QUESTION_DESCRIPTIONS) else ""
+                ),
+                "question": question.get("question"),
+                "response": question.get("response"),
+                "improved_response": question.get("improved_response"),
+                "concept": flow[i].get("concept") if i < len(flow) else None,
+            }
+        )
+    return rendered
+
+
+def dump_json_bytes(obj):
+    """Serialize obj to JSON bytes, preferring orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
+
+def dump_payload(obj):
+    """Serialize a conversation payload, preferring binary MessagePack.
+
+    app.py unpacks with the same preference order, so both sides agree as
+    long as they run from the same environment.
+    """
+    if msgpack is not None:
+        return msgpack.packb(obj, use_bin_type=True)
+    return dump_json_bytes(obj)
+
+
+def stream_conversations():
+    """Yield conversations one at a time without loading the whole file."""
+    with open("conversations.json", "rb") as f:
+        # use_float: ijson otherwise yields Decimal for non-integer numbers,
+        # which none of the payload serializers accept
+        yield from ijson.items(f, "item", use_float=True)
+
+
+class ReservoirSampler:
+    """Uniformly sample up to k items from a stream (Algorithm R)."""
+
+    def __init__(self, k):
+        self.k = k
+        self.items = []
+        self.seen = 0
+
+    def add(self, item):
+        self.seen += 1
+        if len(self.items) < self.k:
+            self.items.append(item)
+        else:
+            j = random.randrange(self.seen)
+            if j < self.k:
+                self.items[j] = item
+
+
 def preprocess_data(base_conversations=500):
     """
     Preprocess conversation data and save to disk.
@@ -34,62 +157,60 @@ def preprocess_data(base_conversations=500):
     # Create data directory if it doesn't exist
     Path("processed_data").mkdir(exist_ok=True)
 
-    # Load original JSON data
-    try:
-        with open("conversations.json", "r") as f:
-            data = json.load(f)
-    except json.JSONDecodeError as e:
-        print(f"Error decoding JSON: {e}")
-        print("Attempting to fix the JSON file...")
-        with open("conversations.json", "r") as f:
-            content = f.read()
-        # Remove any trailing commas in arrays or objects
-        content = content.replace(",]", "]").replace(",}", "}")
-        # Attempt to load the fixed JSON
+    # First pass: count conversations per assignment. Stream with ijson when
+    # available so the whole file never sits in memory; fall back to a full
+    # in-memory load (with trailing-comma repair) otherwise.
+    data = None
+    assignment_counts = Counter()
+    if ijson is not None:
         try:
-            data = json.loads(content)
-        except json.JSONDecodeError as e:
-            print(f"Unable to fix JSON file. Error: {e}")
+            for conv in stream_conversations():
+                assignment_counts[conv["assignment"]["_id"]] += 1
+        except ijson.JSONError:
+            # Malformed JSON; streaming can't repair it, load fully instead
+            assignment_counts.clear()
+    if not assignment_counts:
+        data = load_conversations()
+        if data is None:
             return
+        assignment_counts = Counter(conv["assignment"]["_id"] for conv in data)
 
     # Find most popular assignment first
-    assignment_counts = Counter(conv["assignment"]["_id"] for conv in data)
     most_popular_assignment_id, popular_count = assignment_counts.most_common(1)[0]
 
-    # Get all conversations from the most popular assignment
-    popular_assignment_conversations = [
-        conv for conv in data if conv["assignment"]["_id"] == most_popular_assignment_id
-    ]
-
-    # Remove popular assignment conversations from main dataset to avoid duplicates
-    remaining_conversations = [
-        conv for conv in data if conv["assignment"]["_id"] != most_popular_assignment_id
-    ]
-
-    # Split remaining conversations by concept presence
-    with_concepts = [
-        conv for conv in remaining_conversations if has_valid_concepts(conv)
-    ]
-    without_concepts = [
-        conv for conv in remaining_conversations if not has_valid_concepts(conv)
-    ]
+    # Second pass: bucket conversations in a single loop (re-streaming when
+    # possible) — popular assignment kept in full, the rest reservoir-sampled
+    # by concept presence so at most `half` items per bucket stay in memory
+    half = base_conversations // 2  # This will be 250 for base_conversations=500
+    popular_assignment_conversations = []
+    with_sampler = ReservoirSampler(half)
+    without_sampler = ReservoirSampler(half)
+    for conv in data if data is not None else stream_conversations():
+        # Concept check inlined and computed exactly once per conversation;
+        # the bool travels with the conversation so it is never recomputed
+        concepts = conv.get("assignment", {}).get("concepts") or []
+        hv = bool(concepts) and all(concepts)
+        if conv["assignment"]["_id"] == most_popular_assignment_id:
+            popular_assignment_conversations.append((conv, hv))
+        elif hv:
+            with_sampler.add((conv, hv))
+        else:
+            without_sampler.add((conv, hv))
+    with_concepts = with_sampler.items
+    without_concepts = without_sampler.items
 
     print(f"\nInitial counts:")
-    print(f"Found {len(with_concepts)} conversations with concepts")
-    print(f"Found {len(without_concepts)} conversations without concepts")
+    print(f"Found {with_sampler.seen} conversations with concepts")
+    print(f"Found {without_sampler.seen} conversations without concepts")
     print(
         f"Found {len(popular_assignment_conversations)} conversations in most popular assignment"
     )
 
-    # Sample equal amounts from remaining conversations
-    half = base_conversations // 2  # This will be 250 for base_conversations=500
-    with_concepts = random.sample(with_concepts, min(half, len(with_concepts)))
-    without_concepts = random.sample(without_concepts, min(half, len(without_concepts)))
-
-    # Combine all conversations we want to keep
-    sampled_conversations = (
-        with_concepts + without_concepts + popular_assignment_conversations
-    )
+    # Combine all conversations we want to keep, unzipping the carried
+    # has_concepts flags
+    sampled = with_concepts + without_concepts + popular_assignment_conversations
+    sampled_conversations = [conv for conv, _ in sampled]
+    has_concepts_flags = [hv for _, hv in sampled]
 
     print(f"\nFinal sampling:")
     print(f"- Sampled {len(with_concepts)} conversations with concepts")
@@ -99,76 +220,82 @@ def preprocess_data(base_conversations=500):
     )
     print(f"Total conversations to process: {len(sampled_conversations)}")
 
-    # Process conversations into DataFrame format
-    conversations = []
-    raw_conversations = {}  # Store raw data separately
-    popular_assignment_data = {}  # Store popular assignment data separately
-
+    # Precompute render-ready question dicts so the app's display loop is a
+    # flat iteration with no nested .get chains
     for conv in sampled_conversations:
-        assignment = conv.get("assignment", {})
-        student = conv.get("student", {})
-        teacher = conv.get("teacher", {})
-
-        # Get student reading/essay
-        student_reading = get_student_reading(conv)
-
-        conv_id = conv.get("_id")
-        record = {
-            "conversation_id": conv_id,
-            "assignment_id": assignment.get("_id"),
-            "assignment_name": assignment.get("title"),
-            "assignment_type": assignment.get("assignment_type"),
-            "assignment_subject": assignment.get("subject"),
-            "assignment_grade": assignment.get("grade"),
-            "has_concepts": has_valid_concepts(conv),
-            "concepts": assignment.get("concepts", []),
-            "student_id": student.get("_id"),
-            "student_name": student.get("name"),
-            "teacher_id": teacher.get("_id"),
-            "teacher_name": teacher.get("name"),
-            "student_reading": student_reading,
-            "is_popular_assignment": conv["assignment"]["_id"]
-            == most_popular_assignment_id,
-        }
-        conversations.append(record)
-        raw_conversations[conv_id] = conv
-
-        # Store popular assignment data separately
-        if conv["assignment"]["_id"] == most_popular_assignment_id:
-            popular_assignment_data[conv_id] = conv
+        conv["questions_render"] = build_questions_render(conv)
 
-    # Convert to DataFrame and save as parquet
-    df = pd.DataFrame(conversations)
-    df.to_parquet("processed_data/conversations.parquet")
+    # Flatten the nested conversation dicts in one vectorized call instead of
+    # building a record dict per row in a Python loop
+    flat = pd.json_normalize(sampled_conversations, max_level=1)
+    df = pd.DataFrame(
+        {
+            "conversation_id": flat["_id"],
+            "assignment_id": flat["assignment._id"],
+            "assignment_name": flat["assignment.title"],
+            "assignment_type": flat["assignment.assignment_type"],
+            "assignment_subject": flat["assignment.subject"],
+            "assignment_grade": flat["assignment.grade"],
+            "has_concepts": has_concepts_flags,
+            "concepts": flat["assignment.concepts"],
+            "student_id": flat["student._id"],
+            "student_name": flat["student.name"],
+            "teacher_id": flat["teacher._id"],
+            "teacher_name": flat["teacher.name"],
+            "student_reading": [
+                get_student_reading(c) for c in sampled_conversations
+            ],
+            "is_popular_assignment": flat["assignment._id"].eq(
+                most_popular_assignment_id
+            ),
+        }
+    )
 
-    # Save raw conversations as JSON
-    with open("processed_data/raw_conversations.json", "w") as f:
-        json.dump(raw_conversations, f)
+    # Low-cardinality string columns dictionary-encode well and filter faster
+    # as categoricals (comparisons run on integer codes)
+    categorical_columns = [
+        "assignment_name",
+        "assignment_type",
+        "assignment_subject",
+        "assignment_grade",
+        "teacher_name",
+    ]
+    for column in categorical_columns:
+        df[column] = df[column].astype("category")
 
-    # Save popular assignment data separately
-    with open("processed_data/popular_assignment.json", "w") as f:
-        json.dump(
-            {
-                "assignment_id": most_popular_assignment_id,
-                "assignment_name": popular_assignment_conversations[0]["assignment"][
-                    "title"
-                ],
-                "conversations": popular_assignment_data,
-            },
-            f,
-        )
+    # Modest row groups let the app skip whole groups via predicate pushdown
+    df.to_parquet(
+        "processed_data/conversations.parquet",
+        compression="zstd",
+        use_dictionary=True,
+        row_group_size=512,
+    )
 
-    print(f"\nData breakdown:")
-    print(
-        f"- Most popular assignment: {popular_assignment_conversations[0]['assignment']['title']}"
+    # Raw payloads in their own parquet, sorted by id with one row group per
+    # conversation, so the app can memory-map the file and fetch a single
+    # conversation without touching the rest
+    payloads = sorted(
+        (conv.get("_id"), dump_payload(conv)) for conv in sampled_conversations
     )
-    print(
-        f"  - Type: {popular_assignment_conversations[0]['assignment']['assignment_type']}"
+    raw_table = pa.table(
+        {
+            "conversation_id": [cid for cid, _ in payloads],
+            "raw": [raw for _, raw in payloads],
+        }
     )
-    print(
-        f"  - Subject: {popular_assignment_conversations[0]['assignment']['subject']}"
+    pq.write_table(
+        raw_table,
+        "processed_data/raw_conversations.parquet",
+        row_group_size=1,
+        compression="zstd",
     )
-    print(f"  - Grade: {popular_assignment_conversations[0]['assignment']['grade']}")
+
+    popular_assignment = popular_assignment_conversations[0][0]["assignment"]
+    print(f"\nData breakdown:")
+    print(f"- Most popular assignment: {popular_assignment['title']}")
+    print(f"  - Type: {popular_assignment['assignment_type']}")
+    print(f"  - Subject: {popular_assignment['subject']}")
+    print(f"  - Grade: {popular_assignment['grade']}")
 
     # Print storage info
     processed_data_dir = Path("processed_data")
@@ -177,10 +304,7 @@ def preprocess_data(base_conversations=500):
         f"- conversations.parquet: {(processed_data_dir / 'conversations.parquet').stat().st_size / 1024:.1f} KB"
     )
     print(
-        f"- raw_conversations.json: {(processed_data_dir / 'raw_conversations.json').stat().st_size / 1024:.1f} KB"
-    )
-    print(
-        f"- popular_assignment.json: {(processed_data_dir / 'popular_assignment.json').stat().st_size / 1024:.1f} KB"
+        f"- raw_conversations.parquet: {(processed_data_dir / 'raw_conversations.parquet').stat().st_size / 1024:.1f} KB"
     )
 
 